@@ -1,9 +1,12 @@
+from functools import lru_cache
 from typing import Tuple, Union, List, Optional
 
 import geopandas as gpd
 import numpy as np
-import osmnx as ox
 import pandas as pd
+import shapely
+import streamlit as st
+from pyproj import CRS, Transformer
 from shapely.geometry import LineString, Polygon
 
 highway_priority = [
@@ -13,11 +16,21 @@ highway_priority = [
     'tertiary_link', 'rest_area', 'crossing'
 ]
 
+# rank of each highway type, lower is more prioritized
+_HIGHWAY_RANK = {highway: rank for rank, highway in enumerate(highway_priority)}
 
+# tolerance doublings after which a LineString is considered degenerate and reduced to its endpoints
+_MAX_SIMPLIFY_ITERATIONS = 32
+
+
+# only the last networks are kept in memory, after a restart osmnx answers from its own cache of the responses
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={Polygon: lambda polygon: polygon.wkb})
 def get_gdfs_from_polygon(polygon: Polygon, network_type: str = 'drive') -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
     """
     Generate nodes and edges GeoDataFrames from a given polygon and network type.
 
+    Results are cached by the WKB of the polygon and the network type, so the same area is downloaded only once.
+
     Parameters:
     polygon (Polygon): The polygon defining the area of interest.
     network_type (str): The type of network to retrieve. Defaults to 'drive'.
@@ -25,6 +38,9 @@ def get_gdfs_from_polygon(polygon: Polygon, network_type: str = 'drive') -> Tupl
     Returns:
     Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]: A tuple containing the nodes and edges GeoDataFrames.
     """
+    # osmnx is slow to import and only needed when points are optimized
+    import osmnx as ox
+
     G = ox.graph_from_polygon(polygon, network_type=network_type)
 
     gdf_nodes, gdf_edges = ox.graph_to_gdfs(
@@ -35,11 +51,12 @@ def get_gdfs_from_polygon(polygon: Polygon, network_type: str = 'drive') -> Tupl
         fill_edge_geometry=True
     )
 
-    gdf_nodes = gdf_nodes.to_crs(epsg=4326)
-    gdf_edges = gdf_edges.to_crs(epsg=4326)
+    gdf_nodes = reproject_gdf(gdf_nodes, 'EPSG:4326')
+    gdf_edges = reproject_gdf(gdf_edges, 'EPSG:4326')
 
-    gdf_nodes.reset_index(drop=True, inplace=True)
-    gdf_edges.reset_index(drop=True, inplace=True)
+    # replace the osmid / (u, v, key) indexes without going through reset_index
+    gdf_nodes.index = pd.RangeIndex(len(gdf_nodes))
+    gdf_edges.index = pd.RangeIndex(len(gdf_edges))
 
     return gdf_nodes, gdf_edges
 
@@ -52,12 +69,12 @@ def select_highway_type(street_type: Union[str, List[str]]) -> str:
     street_type (Union[str, List[str]]): The street type or list of street types.
 
     Returns:
-    str: The most prioritized highway type.
+    str: The most prioritized highway type, or the first of the list if none of them is prioritized.
     """
     if isinstance(street_type, list):
-        for highway in highway_priority:
-            if highway in street_type:
-                return highway
+        return min((s for s in street_type if s in _HIGHWAY_RANK),
+                   key=_HIGHWAY_RANK.__getitem__,
+                   default=street_type[0])
     return street_type
 
 
@@ -87,20 +104,138 @@ def filter_data(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     gpd.GeoDataFrame: The GeoDataFrame cleaned.
     """
 
-    # the highway column might have list of values, we take only one based on priority
-    gdf['highway'] = gdf['highway'].apply(select_highway_type)
+    # find in a single pass the rows holding lists, only object columns can hold them
+    list_masks = {}
+    for column in gdf.select_dtypes(include='object').columns:
+        is_list = gdf[column].map(type).eq(list)
+        if is_list.any():
+            list_masks[column] = is_list
+
+    for column, is_list in list_masks.items():
+        if column == 'highway':
+            # the highway column might have list of values, we take only one based on priority
+            gdf.loc[is_list, column] = gdf.loc[is_list, column].map(select_highway_type)
+        elif column != 'maxspeed':
+            gdf.loc[is_list, column] = gdf.loc[is_list, column].astype(str)
 
     # the maxspeed column might have list of values, we take the greatest of the list
-    gdf['maxspeed'] = gdf['maxspeed'].apply(select_max_value)
+    if 'maxspeed' in list_masks:
+        maxspeed = pd.to_numeric(gdf['maxspeed'].reset_index(drop=True).explode(), errors='coerce')
+        gdf['maxspeed'] = maxspeed.groupby(level=0).max().to_numpy()
+    else:
+        gdf['maxspeed'] = pd.to_numeric(gdf['maxspeed'], errors='coerce')
+
+    # the few highway types are stored as categories, so that filtering on them compares integer codes
+    if 'highway' in gdf.columns:
+        gdf['highway'] = gdf['highway'].astype('category')
+    return gdf
+
+
+@lru_cache(maxsize=16)
+def _cached_transformer(src_crs: CRS, dst_crs: CRS) -> Transformer:
+    """
+    Build a Transformer between two CRSs once and reuse it on the following calls.
+
+    Parameters:
+    src_crs (CRS): The source coordinate reference system.
+    dst_crs (CRS): The destination coordinate reference system.
+
+    Returns:
+    Transformer: The transformer from src_crs to dst_crs, with x/y axis order.
+    """
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def reproject_geometries(geometries: np.ndarray, src_crs: CRS, dst_crs: Union[str, int, CRS]) -> np.ndarray:
+    """
+    Reproject an array of geometries with a cached Transformer, in a single vectorized call over their coordinates.
+
+    Parameters:
+    geometries (np.ndarray): The geometries to reproject.
+    src_crs (CRS): The coordinate reference system of the geometries.
+    dst_crs (Union[str, int, CRS]): The target coordinate reference system.
+
+    Returns:
+    np.ndarray: The reprojected geometries, or the input ones if they are already in the target CRS.
+    """
+    dst_crs = CRS.from_user_input(dst_crs)
+    if src_crs == dst_crs:
+        return geometries
 
-    gdf['maxspeed'] = pd.to_numeric(gdf['maxspeed'])
+    transformer = _cached_transformer(CRS.from_user_input(src_crs), dst_crs)
+    return shapely.transform(geometries, transformer.transform, interleaved=False)
 
-    for column in gdf.columns:
-        if any(isinstance(val, list) for val in gdf[column]):
-            gdf[column] = gdf[column].apply(lambda x: str(x) if isinstance(x, list) else x)
+
+def reproject_gdf(gdf: gpd.GeoDataFrame, crs: Union[str, int, CRS]) -> gpd.GeoDataFrame:
+    """
+    Reproject a GeoDataFrame using a cached Transformer, skipping the work if it is already in the target CRS.
+
+    Parameters:
+    gdf (gpd.GeoDataFrame): The GeoDataFrame to reproject, it must have a valid CRS.
+    crs (Union[str, int, CRS]): The target coordinate reference system.
+
+    Returns:
+    gpd.GeoDataFrame: The reprojected GeoDataFrame, or the input one if no reprojection was needed.
+    """
+    crs = CRS.from_user_input(crs)
+    if gdf.crs == crs:
+        return gdf
+
+    geometry = reproject_geometries(gdf.geometry.to_numpy(), gdf.crs, crs)
+
+    gdf = gdf.copy()
+    gdf[gdf.geometry.name] = gpd.GeoSeries(geometry, index=gdf.index, crs=crs)
     return gdf
 
 
+def _sjoin_nearest_points(streets_gdf: gpd.GeoDataFrame,
+                          points_gdf: gpd.GeoDataFrame,
+                          max_distance: float,
+                          distance_col: str) -> gpd.GeoDataFrame:
+    """
+    Inner join every street with its nearest points within max_distance, using a spatial index of the streets.
+
+    The output matches gpd.sjoin_nearest(streets_gdf, points_gdf, how='inner'): equidistant points are all kept,
+    the index comes from the streets and the one of the points is stored in the index_right column.
+
+    Parameters:
+    streets_gdf (gpd.GeoDataFrame): The GeoDataFrame containing streets edges data.
+    points_gdf (gpd.GeoDataFrame): The GeoDataFrame containing points data, in the same CRS as the streets.
+    max_distance (float): The maximum distance for considering nearest neighbors.
+    distance_col (str): The name of the column to store the distance values.
+
+    Returns:
+    gpd.GeoDataFrame: The streets joined with their nearest points.
+    """
+    street_geometries = streets_gdf.geometry.to_numpy()
+    point_geometries = points_gdf.geometry.to_numpy()
+
+    tree = shapely.STRtree(street_geometries)
+    point_idx, street_idx = tree.query(point_geometries, predicate='dwithin', distance=max_distance)
+    distances = shapely.distance(street_geometries[street_idx], point_geometries[point_idx])
+
+    # keep for every street only its nearest points, sorted like sjoin_nearest does
+    nearest = distances == pd.Series(distances).groupby(street_idx).transform('min').to_numpy()
+    order = np.lexsort((point_idx[nearest], street_idx[nearest]))
+    street_idx = street_idx[nearest][order]
+    point_idx = point_idx[nearest][order]
+    distances = distances[nearest][order]
+
+    left = streets_gdf.iloc[street_idx]
+    right = points_gdf.drop(columns=points_gdf.geometry.name).iloc[point_idx]
+
+    overlap = left.columns.intersection(right.columns)
+    left = left.rename(columns={column: f'{column}_left' for column in overlap})
+    right = right.rename(columns={column: f'{column}_right' for column in overlap})
+
+    spatial_gdf = pd.concat([left.reset_index(drop=True), right.reset_index(names='index_right')], axis=1)
+    spatial_gdf = gpd.GeoDataFrame(spatial_gdf, geometry=left.geometry.name, crs=streets_gdf.crs)
+    spatial_gdf.index = left.index
+    spatial_gdf[distance_col] = distances
+
+    return spatial_gdf
+
+
 def merge_points_gdf_with_streets_edges(points_gdf: gpd.GeoDataFrame,
                                         streets_gdf: gpd.GeoDataFrame,
                                         how: str = 'inner',
@@ -123,29 +258,80 @@ def merge_points_gdf_with_streets_edges(points_gdf: gpd.GeoDataFrame,
     Returns:
     gpd.GeoDataFrame: The resulting GeoDataFrame after the spatial join with CRS set to the specified output CRS.
     """
-    points_gdf.to_crs(join_crs, inplace=True)
-    streets_gdf.to_crs(join_crs, inplace=True)
+    points_gdf = reproject_gdf(points_gdf, join_crs)
+    streets_gdf = reproject_gdf(streets_gdf, join_crs)
 
     streets_gdf = streets_gdf.drop(columns=['index_left', 'index_right'], errors='ignore')
     points_gdf = points_gdf.drop(columns=['index_left', 'index_right'], errors='ignore')
 
-    spatial_gdf = gpd.sjoin_nearest(streets_gdf,
-                                    points_gdf,
-                                    how=how,
-                                    max_distance=max_distance,
-                                    distance_col=distance_col)
-    spatial_gdf.to_crs(output_crs, inplace=True)
+    if how == 'inner':
+        spatial_gdf = _sjoin_nearest_points(streets_gdf, points_gdf, max_distance, distance_col)
+    else:
+        spatial_gdf = gpd.sjoin_nearest(streets_gdf,
+                                        points_gdf,
+                                        how=how,
+                                        max_distance=max_distance,
+                                        distance_col=distance_col)
+    return reproject_gdf(spatial_gdf, output_crs)
+
+
+def _simplify_to_num_points(geometries: np.ndarray, num_points: np.ndarray) -> np.ndarray:
+    """
+    Simplify LineStrings with Ramer-Douglas-Peucker until each of them has at most the given number of points.
+
+    The tolerance of every LineString starts from a thousandth of its length and is doubled
+    until the simplified LineString is small enough.
+
+    Parameters:
+    geometries (np.ndarray): The LineStrings to be simplified.
+    num_points (np.ndarray): The maximum number of points of each simplified LineString, at least 2.
+
+    Returns:
+    np.ndarray: The simplified LineStrings.
+    """
+    tolerance = shapely.length(geometries) / 1000
+    simplified = shapely.simplify(geometries, tolerance, preserve_topology=False)
+    too_long = shapely.get_num_coordinates(simplified) > num_points
+
+    for _ in range(_MAX_SIMPLIFY_ITERATIONS):
+        if not too_long.any():
+            break
+        tolerance[too_long] *= 2
+        simplified[too_long] = shapely.simplify(geometries[too_long], tolerance[too_long], preserve_topology=False)
+        too_long = shapely.get_num_coordinates(simplified) > num_points
+
+    # degenerate LineStrings, e.g. with zero length, are reduced to their endpoints
+    if too_long.any():
+        endpoints = np.stack([shapely.get_coordinates(shapely.get_point(geometries[too_long], 0)),
+                              shapely.get_coordinates(shapely.get_point(geometries[too_long], -1))], axis=1)
+        simplified[too_long] = shapely.linestrings(endpoints)
+
+    return simplified
+
+
+def _num_points_from_length(lengths: np.ndarray) -> np.ndarray:
+    """
+    Compute the default number of points of simplified LineStrings from their lengths.
+
+    Parameters:
+    lengths (np.ndarray): The lengths of the LineStrings.
+
+    Returns:
+    np.ndarray: The number of points, between 3 and 20.
+    """
+    return np.clip((lengths / 1000).astype(int) + 2, 3, 20)
 
-    return spatial_gdf
 
 def simplify_linestring(linestring: LineString,
                         points_between: Optional[int] = None) -> List[Tuple[float, float]]:
     """
     Simplifies a LineString by reducing the number of points based on the specified points_between parameter.
 
+    Points are dropped with the Ramer-Douglas-Peucker algorithm, so that the most significant bends are kept.
+
     Parameters:
     linestring (LineString): The LineString object to be simplified.
-    points_between (Optional[int]): The number of points to include between the start and end points.
+    points_between (Optional[int]): The maximum number of points to include between the start and end points.
                                     If None, a default calculation is used based on the length of the LineString.
                                     If -1, all points are returned.
                                     If 0, only the start and end points are returned.
@@ -157,42 +343,70 @@ def simplify_linestring(linestring: LineString,
     Raises:
     ValueError: If points_between is less than -1.
     """
-    coords = list(linestring.coords)
-
     if points_between is None:
-        length = linestring.length
-        num_points = max(3, min(20, int(length / 1000) + 2))
+        num_points = _num_points_from_length(np.array([linestring.length]))
     elif points_between < -1:
         raise ValueError("points_between must be non-negative or -1")
     elif points_between == -1:
-        return coords
+        return list(linestring.coords)
     elif points_between == 0:
+        coords = linestring.coords
         return [coords[0], coords[-1]]
     else:
-        num_points = points_between + 2
+        num_points = np.array([points_between + 2])
+
+    return list(_simplify_to_num_points(np.array([linestring]), num_points)[0].coords)
+
+
+def simplify_linestrings_batch(linestrings: gpd.GeoSeries,
+                               points_between: Optional[int] = None) -> np.ndarray:
+    """
+    Simplifies all the LineStrings of a GeoSeries at once, with the same rules as simplify_linestring.
+
+    The whole array is simplified and its coordinates extracted with vectorized shapely calls,
+    geometries which are not LineStrings are skipped.
 
-    return [coords[i] for i in np.linspace(0, len(coords) - 1, num_points, dtype=int)]
+    Parameters:
+    linestrings (gpd.GeoSeries): The LineStrings to be simplified.
+    points_between (Optional[int]): The maximum number of points to include between the start and end points
+                                    of each LineString, see simplify_linestring.
+
+    Returns:
+    np.ndarray: A (N, 2) array with the (x, y) coordinates of all the simplified LineStrings, in order.
+
+    Raises:
+    ValueError: If points_between is less than -1.
+    """
+    if points_between is not None and points_between < -1:
+        raise ValueError("points_between must be non-negative or -1")
+
+    geometries = linestrings.to_numpy()
+    geometries = geometries[shapely.get_type_id(geometries) == shapely.GeometryType.LINESTRING]
+
+    if points_between == -1 or not len(geometries):
+        return shapely.get_coordinates(geometries)
+
+    if points_between is None:
+        num_points = _num_points_from_length(shapely.length(geometries))
+    else:
+        num_points = np.full(len(geometries), points_between + 2)
+
+    return shapely.get_coordinates(_simplify_to_num_points(geometries, num_points))
 
 
 def convert_gdf_to_single_point_list(gdf: gpd.GeoDataFrame,
                                      geometry_column: str = 'geometry',
-                                     points_between: int = 3) -> List[Tuple[float, float]]:
+                                     points_between: Optional[int] = 3) -> List[Tuple[float, float]]:
     """
     Convert linestrings in a GeoDataFrame to a single list of points.
 
     Parameters:
     gdf (GeoDataFrame): GeoDataFrame containing linestrings.
     geometry_column (str): Name of the column containing geometries.
-    points_between (int): Number of points to select between first and last for each linestring.
+    points_between (Optional[int]): Number of points to select between first and last for each linestring.
 
     Returns:
     List[Tuple[float, float]]: Single list of (lat, lon) tuples representing the points in the linestrings.
     """
-    all_points = []
-
-    for _, row in gdf.iterrows():
-        linestring = row[geometry_column]
-        if isinstance(linestring, LineString):
-            selected_points = simplify_linestring(linestring, points_between)
-            all_points.extend([(lat, lon) for lon, lat in selected_points])
-    return all_points
+    coords = simplify_linestrings_batch(gdf[geometry_column], points_between)
+    return list(map(tuple, coords[:, ::-1].tolist()))
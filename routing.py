@@ -1,10 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, List, Optional
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import MissingSchema, InvalidURL, Timeout
 
+import shapely
 from shapely.geometry import LineString
 import polyline
+from urllib3.util.retry import Retry
+
+# Shared session, retrying failed connections to the OSRM server
+_OSRM_SESSION = requests.Session()
+_OSRM_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, read=0, backoff_factor=0.3))
+_OSRM_SESSION.mount('http://', _OSRM_ADAPTER)
+_OSRM_SESSION.mount('https://', _OSRM_ADAPTER)
+
+# 5-bit chunks needed to encode any coordinate delta with precision up to 6 decimals
+_POLYLINE_MAX_CHUNKS = 8
 
 
 def get_osrm_trip(
@@ -48,31 +62,13 @@ def get_osrm_trip(
         This function relies on external services and may fail due to network issues or service unavailability.
     """
 
-    osrm_url = (
-        f"{base_url}/trip/v1/{profile}/polyline({encoded_polyline})?"
-        f"roundtrip={roundtrip}&source=first&destination=last&"
-        f"steps={steps}&"
-        f"geometries={geometries}&"
-        f"overview={overview}&"
-        f"annotations={annotations}"
-    )
+    osrm_url = _build_trip_url(encoded_polyline, profile, steps, geometries, overview, annotations, roundtrip,
+                               base_url)
 
     try:
-        response = requests.get(osrm_url, verify=False)
+        response = _OSRM_SESSION.get(osrm_url, verify=False, timeout=30)
         if response.status_code == 200:
-            data = response.json()
-            trips = data.get('trips', [])
-            routes = []
-            for trip in trips:
-                for leg in trip.get('legs', []):
-                    for step in leg.get('steps', []):
-                        encoded_polyline = step.get('geometry', '')
-                        if encoded_polyline:
-                            decoded_route = polyline.decode(encoded_polyline)
-                            if len(decoded_route) > 1:
-                                routes.append(LineString([(lon, lat) for lat, lon in decoded_route]))
-
-            return routes if routes else None
+            return _decode_trip_response(response)
         else:
             return response
     except (MissingSchema, InvalidURL):
@@ -82,4 +78,140 @@ def get_osrm_trip(
     except requests.HTTPError as http_error:
         return http_error.response
     except requests.RequestException as req_error:
-        raise ValueError(f"Request failed: {str(req_error)}") from req_error
\ No newline at end of file
+        raise ValueError(f"Request failed: {str(req_error)}") from req_error
+
+
+def get_osrm_trips_batch(
+        encoded_polylines: List[str],
+        profile: str = 'driving',
+        steps: str = 'true',
+        geometries: str = 'polyline',
+        overview: str = 'full',
+        annotations: str = 'true',
+        roundtrip: str = 'false',
+        base_url: str = 'http://router.project-osrm.org',
+        max_workers: int = 8,
+) -> List[Optional[Union[List[LineString], requests.Response]]]:
+    """
+    Fetch and process several OSRM trips in parallel.
+
+    Every encoded polyline is sent to the OSRM server as in get_osrm_trip, the requests are
+    issued concurrently from a thread pool sharing the same connection pool.
+
+    Args:
+        encoded_polylines (List[str]): The encoded polylines representing the points of each trip.
+        profile (str, optional): The routing profile to use. Defaults to 'driving'.
+        steps (str, optional): Whether to include steps in the response. Defaults to 'true'.
+        geometries (str, optional): The geometry format for the response. Defaults to 'polyline'.
+        overview (str, optional): The type of overview geometry to include. Defaults to 'full'.
+        annotations (str, optional): Whether to include annotations. Defaults to 'true'.
+        roundtrip (str, optional): Whether the trips should return to their start point. Defaults to 'false'.
+        base_url (str, optional): The base URL of the OSRM server. Defaults to 'http://router.project-osrm.org'.
+        max_workers (int, optional): The maximum number of concurrent requests. Defaults to 8.
+
+    Returns:
+        List[Optional[Union[List[LineString], requests.Response]]]:
+            The result of get_osrm_trip for each encoded polyline, in the same order.
+
+    Raises:
+        ValueError: If the URL is invalid or a request fails.
+        TimeoutError: If a request times out.
+    """
+    def fetch(encoded_polyline: str) -> Optional[Union[List[LineString], requests.Response]]:
+        return get_osrm_trip(encoded_polyline,
+                             profile=profile,
+                             steps=steps,
+                             geometries=geometries,
+                             overview=overview,
+                             annotations=annotations,
+                             roundtrip=roundtrip,
+                             base_url=base_url)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fetch, encoded_polylines))
+
+
+def encode_polyline(coords: np.ndarray, precision: int = 5) -> str:
+    """
+    Encode coordinates with the Google polyline algorithm, all at once with NumPy.
+
+    The output is the same as polyline.encode, but the rounding, the deltas and the 5-bit chunking
+    are computed on whole arrays instead of in a Python loop over every coordinate.
+
+    Args:
+        coords (np.ndarray): The (N, 2) array of the (lat, lon) coordinates to encode.
+        precision (int, optional): The number of decimals kept by the encoding. Defaults to 5.
+
+    Returns:
+        str: The encoded polyline.
+    """
+    # round half away from zero as the reference implementation does
+    scaled = np.asarray(coords, dtype=float).reshape(-1, 2) * 10 ** precision
+    values = np.copysign(np.floor(np.abs(scaled) + 0.5), scaled).astype(np.int64)
+
+    # every coordinate is encoded as the difference from the previous point, in lat, lon order
+    deltas = np.diff(values, axis=0, prepend=0).ravel()
+    deltas = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    # split every value into 5-bit chunks, all but the last one of each value flagged with 0x20
+    chunk_index = np.arange(_POLYLINE_MAX_CHUNKS)
+    chunks = (deltas[:, None] >> (5 * chunk_index)) & 0x1f
+    num_chunks = 1 + (deltas[:, None] >= 32 ** chunk_index[1:]).sum(axis=1)
+    chunks |= np.where(chunk_index < num_chunks[:, None] - 1, 0x20, 0)
+
+    return (chunks[chunk_index < num_chunks[:, None]] + 63).astype(np.uint8).tobytes().decode('ascii')
+
+
+def _build_trip_url(encoded_polyline: str,
+                    profile: str,
+                    steps: str,
+                    geometries: str,
+                    overview: str,
+                    annotations: str,
+                    roundtrip: str,
+                    base_url: str) -> str:
+    """
+    Build the URL of an OSRM trip request, see get_osrm_trip for the meaning of the arguments.
+
+    Returns:
+        str: The URL of the request.
+    """
+    return (
+        f"{base_url}/trip/v1/{profile}/polyline({encoded_polyline})?"
+        f"roundtrip={roundtrip}&source=first&destination=last&"
+        f"steps={steps}&"
+        f"geometries={geometries}&"
+        f"overview={overview}&"
+        f"annotations={annotations}"
+    )
+
+
+def _decode_trip_response(response: requests.Response) -> Optional[List[LineString]]:
+    """
+    Extract the step geometries of a successful OSRM trip response.
+
+    Args:
+        response (requests.Response): The response of the OSRM server.
+
+    Returns:
+        Optional[List[LineString]]: The route segments, or None if the response contains no valid route.
+    """
+    data = response.json()
+    trips = data.get('trips', [])
+    decoded_routes = []
+    for trip in trips:
+        for leg in trip.get('legs', []):
+            for step in leg.get('steps', []):
+                step_polyline = step.get('geometry', '')
+                if step_polyline:
+                    decoded_route = polyline.decode(step_polyline)
+                    if len(decoded_route) > 1:
+                        decoded_routes.append(np.asarray(decoded_route, dtype=float))
+
+    if not decoded_routes:
+        return None
+
+    # build all the LineStrings at once, swapping (lat, lon) to (lon, lat)
+    coords = np.concatenate(decoded_routes)[:, ::-1]
+    indices = np.repeat(np.arange(len(decoded_routes)), [len(route) for route in decoded_routes])
+    return shapely.linestrings(coords, indices=indices).tolist()
@@ -1,17 +1,123 @@
+import io
+from functools import partial
+
 import streamlit as st
+import streamlit.components.v1 as components
 import geopandas as gpd
-import folium
-from folium import FeatureGroup, plugins
-from streamlit_folium import folium_static
+import numpy as np
+import shapely
+from pyproj import CRS
 from shapely import Point
 
 from osm_utils import highway_priority
-from utils import calculate_trip, TransportProfile, interpolate_color, recalculate_uncovered_points
+from utils import calculate_trip, TransportProfile, interpolate_colors, recalculate_uncovered_points, \
+    compute_trip_length, hash_geodataframe
+
+
+WGS84 = CRS.from_epsg(4326)
+
+# Sidebar texts
+HOW_TO_USE_TEXT = """
+1. Upload a GeoJSON file containing points.
+2. Select your transportation mode.
+3. Choose whether you want a roundtrip.
+4. Adjust the number of points to use with the slider.
+5. Click 'Start Trip Calculation'.
+6. View your optimized route and trip statistics.
+7. Download the route as a GeoJSON file if desired.
+"""
+
+ABOUT_TEXT = """
+This app uses the OSM (Open Street Map) to calculate optimal routes between multiple points. 
+It's perfect for planning trips, deliveries, or any scenario where you need to visit multiple locations efficiently.
+"""
+
+# Leaflet callback building a marker with popup from a [lat, lon, popup] row of FastMarkerCluster
+POINT_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2]);
+    return marker;
+};
+"""
+
+# Leaflet callback building a circle marker with popup from a [lat, lon, popup] row of FastMarkerCluster
+CIRCLE_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 5, color: '%s', fill: true, fillColor: '%s'});
+    marker.bindPopup(row[2]);
+    return marker;
+};
+"""
+
+# Number of points above which the circle markers are clustered instead of all being drawn
+CLUSTER_THRESHOLD = 10000
+
+# Simplification tolerance (degrees) and decimals of the route coordinates drawn on the trip map
+ROUTE_TOLERANCE = 1e-5
+ROUTE_DECIMALS = 5
+
+
+def create_points_map(filtered_points):
+    # Import folium lazily to keep the app startup short
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    # extract all the points coordinates at once, swapped to (lat, lon)
+    coords = shapely.get_coordinates(filtered_points.geometry.values)[:, ::-1]
+
+    m = folium.Map(location=coords.mean(axis=0).tolist(), zoom_start=10)
+    FastMarkerCluster(
+        [[lat, lon, f"Point {idx}"] for idx, (lat, lon) in zip(filtered_points.index, coords.tolist())],
+        callback=POINT_MARKER_CALLBACK
+    ).add_to(m)
+    return m
 
 
-def create_trip_map(trip_gdf, filtered_points, uncovered_points, verify_coverage):
-    bounds = trip_gdf.total_bounds
-    center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
+def render_map(m):
+    import folium
+
+    return folium.Figure().add_child(m).render()
+
+
+def create_circle_markers(points, popup_prefix, color):
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    # beyond the threshold even a single layer is too heavy for the browser, the markers are clustered instead
+    if len(points) > CLUSTER_THRESHOLD:
+        coords = shapely.get_coordinates(points.geometry.values)[:, ::-1]
+        return FastMarkerCluster(
+            [[lat, lon, f"{popup_prefix} {idx}"] for idx, (lat, lon) in zip(points.index, coords.tolist())],
+            callback=CIRCLE_MARKER_CALLBACK % (color, color)
+        )
+
+    # Draw all the circles with a single GeoJson layer
+    coords = shapely.get_coordinates(points.geometry.values).tolist()
+    features = [{'type': 'Feature',
+                 'geometry': {'type': 'Point', 'coordinates': xy},
+                 'properties': {'popup': f"{popup_prefix} {idx}"}}
+                for idx, xy in zip(points.index, coords)]
+    return folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        marker=folium.CircleMarker(radius=5, color=color, fill=True, fillColor=color),
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False)
+    )
+
+
+def create_trip_map(trip_gdf, filtered_points, uncovered_points, verify_coverage, tolerance=ROUTE_TOLERANCE):
+    import folium
+    from folium import FeatureGroup, plugins
+
+    # the segments are simplified and rounded to ~1 m before drawing them, shrinking the map HTML
+    geometries = shapely.simplify(trip_gdf.geometry.values, tolerance, preserve_topology=False)
+    geometries = shapely.transform(geometries, lambda xy: np.round(xy, ROUTE_DECIMALS))
+
+    # extract all the segments coordinates at once, swapped to (lat, lon)
+    xy, segment_index = shapely.get_coordinates(geometries, return_index=True)
+    coords = xy[:, ::-1]
+
+    center = ((coords.min(axis=0) + coords.max(axis=0)) / 2).tolist()
 
     m = folium.Map(location=center, zoom_start=10)
 
@@ -19,54 +125,44 @@ def create_trip_map(trip_gdf, filtered_points, uncovered_points, verify_coverage
     points_group = FeatureGroup(name='Points')
     markers_group = FeatureGroup(name='Markers')
 
-    for idx, row in filtered_points.iterrows():
-        folium.CircleMarker(
-            [row.geometry.y, row.geometry.x],
-            radius=5,
-            popup=f"Point {idx}",
-            color="blue",
-            fill=True,
-            fillColor="blue"
-        ).add_to(points_group)
+    create_circle_markers(filtered_points, "Point", "blue").add_to(points_group)
 
     folium.Marker(
-        [trip_gdf.iloc[0].geometry.coords[0][1], trip_gdf.iloc[0].geometry.coords[0][0]],
+        coords[0].tolist(),
         popup="Start",
         icon=folium.Icon(color="green", icon="play"),
     ).add_to(markers_group)
 
     folium.Marker(
-        [trip_gdf.iloc[-1].geometry.coords[-1][1], trip_gdf.iloc[-1].geometry.coords[-1][0]],
+        coords[-1].tolist(),
         popup="End",
         icon=folium.Icon(color="red", icon="stop"),
     ).add_to(markers_group)
 
-    for idx, row in trip_gdf.iterrows():
-        color = interpolate_color(idx / (len(trip_gdf) - 1), '#00ff00', '#ff0000')
-        pol = folium.PolyLine(
-            locations=[(y, x) for x, y in row.geometry.coords],
-            color=color,
-            weight=3,
-            opacity=0.8,
-            tooltip=f'Segment {idx}',
-        )
-        pol.add_to(lines_group)
-
-        plugins.PolyLineTextPath(
-            polyline=pol,
-            text='→',
-            repeat=True,
-            offset=1,
-            attributes={'fill': '#000000', 'font-weight': 'bold', 'font-size': '34'}
-        ).add_to(lines_group)
-        plugins.PolyLineTextPath(
-            polyline=pol,
-            center=False,
-            text=str(idx),
-            repeat=False,
-            offset=2,
-            attributes={'fill': '#000000', 'font-weight': 'bold', 'font-size': '24'}
-        ).add_to(lines_group)
+    colors = interpolate_colors(np.arange(len(trip_gdf)) / max(len(trip_gdf) - 1, 1), '#00ff00', '#ff0000')
+
+    # Draw all the segments with a single GeoJson layer, each with its own color
+    segments_xy = np.split(xy, np.flatnonzero(np.diff(segment_index)) + 1)
+    features = [{'type': 'Feature',
+                 'geometry': {'type': 'LineString', 'coordinates': segment_xy.tolist()},
+                 'properties': {'segment': f'Segment {idx}', 'color': color}}
+                for idx, segment_xy, color in zip(trip_gdf.index, segments_xy, colors)]
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        style_function=lambda feature: {'color': feature['properties']['color'], 'weight': 3, 'opacity': 0.8},
+        tooltip=folium.GeoJsonTooltip(fields=['segment'], labels=False),
+    ).add_to(lines_group)
+
+    # the direction arrows follow the whole route, drawn on an invisible line not to hide the segments tooltip
+    route = folium.PolyLine(locations=coords.tolist(), stroke=False)
+    route.add_to(lines_group)
+    plugins.PolyLineTextPath(
+        polyline=route,
+        text='→',
+        repeat=True,
+        offset=1,
+        attributes={'fill': '#000000', 'font-weight': 'bold', 'font-size': '34'}
+    ).add_to(lines_group)
 
     m.add_child(lines_group)
     m.add_child(points_group)
@@ -74,15 +170,7 @@ def create_trip_map(trip_gdf, filtered_points, uncovered_points, verify_coverage
 
     if verify_coverage and uncovered_points is not None and not uncovered_points.empty:
         uncovered_group = FeatureGroup(name='Uncovered Points')
-        for idx, row in uncovered_points.iterrows():
-            folium.CircleMarker(
-                [row.geometry.y, row.geometry.x],
-                radius=5,
-                popup=f"Uncovered Point {idx}",
-                color="red",
-                fill=True,
-                fillColor="red"
-            ).add_to(uncovered_group)
+        create_circle_markers(uncovered_points, "Uncovered Point", "red").add_to(uncovered_group)
         m.add_child(uncovered_group)
 
     m.fit_bounds(m.get_bounds())
@@ -90,7 +178,7 @@ def create_trip_map(trip_gdf, filtered_points, uncovered_points, verify_coverage
 
 
 def display_trip_statistics(trip_gdf, profile, verify_coverage, uncovered_points, max_distance):
-    total_distance = sum(line.length for line in trip_gdf.geometry) * 111  # Approximate km conversion
+    total_distance = compute_trip_length(trip_gdf)
     st.write(f"Total trip distance: {total_distance:.2f} km")
 
     estimated_time = total_distance / profile.avg_speed
@@ -104,6 +192,80 @@ def display_trip_statistics(trip_gdf, profile, verify_coverage, uncovered_points
             st.success(f"All points were covered by the calculated route (max distance: {max_distance} meters).")
 
 
+# Running as a fragment, interactions inside the trip section rerun only this function and not the whole app
+@st.fragment
+def display_calculated_trip(filtered_points, profile, verify_coverage, max_distance, tolerance):
+    with st.expander("View Calculated Trip", expanded=True):
+        st.subheader("Map of Calculated Trip")
+
+        # Create and display the map
+        trip_map_html = render_trip_map(st.session_state.trip_gdf, filtered_points,
+                                        st.session_state.uncovered_points, verify_coverage, tolerance)
+        components.html(trip_map_html, width=700, height=510)
+
+        # Display statistics
+        display_trip_statistics(st.session_state.trip_gdf, profile, verify_coverage,
+                                st.session_state.uncovered_points, max_distance)
+
+        # Download buttons, the GeoJSON is only serialized once a button is clicked
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.download_button(
+                label="Download trip as GeoJSON",
+                data=partial(to_geojson, st.session_state.trip_gdf, 'trip'),
+                file_name="trip.geojson",
+                mime="application/json"
+            )
+
+        with col2:
+            if st.session_state.uncovered_points is not None and not st.session_state.uncovered_points.empty:
+                st.download_button(
+                    label="Download uncovered points as GeoJSON",
+                    data=partial(to_geojson, st.session_state.uncovered_points, 'uncovered_points'),
+                    file_name="uncovered_points.geojson",
+                    mime="application/json"
+                )
+
+
+# Render the trip map
+@st.cache_resource(show_spinner=False, max_entries=16, hash_funcs={gpd.GeoDataFrame: hash_geodataframe})
+def render_trip_map(trip_gdf, filtered_points, uncovered_points, verify_coverage, tolerance):
+    return render_map(create_trip_map(trip_gdf, filtered_points, uncovered_points, verify_coverage, tolerance))
+
+
+class TripNotFoundError(Exception):
+    pass
+
+
+# Calculate the trip, raising on failures so that they are not cached
+@st.cache_data(show_spinner=False, ttl=3600,
+               hash_funcs={gpd.GeoDataFrame: hash_geodataframe, Point: lambda point: point.wkb})
+def cached_calculate_trip(points, **kwargs):
+    trip_gdf, uncovered_points = calculate_trip(points, **kwargs)
+    if trip_gdf is None:
+        raise TripNotFoundError()
+    return trip_gdf, uncovered_points
+
+
+# Parse and reproject the uploaded points
+@st.cache_data(show_spinner=False, max_entries=16, ttl=3600)
+def load_points(file_bytes):
+    points = gpd.read_file(io.BytesIO(file_bytes), engine='pyogrio').reset_index(drop=True)
+
+    if points.crs is None or not points.crs.equals(WGS84):
+        points = points.to_crs(WGS84)
+    return points
+
+
+# Serialize the results for the download buttons
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600, hash_funcs={gpd.GeoDataFrame: hash_geodataframe})
+def to_geojson(gdf, layer):
+    buffer = io.BytesIO()
+    gdf.to_file(buffer, driver='GeoJSON', layer=layer, engine='pyogrio')
+    return buffer.getvalue()
+
+
 st.set_page_config(layout="wide")
 
 # Initialize session state variables
@@ -125,6 +287,8 @@ if 'previous_optimize_points' not in st.session_state:
     st.session_state.previous_optimize_points = None
 if 'previous_roundtrip' not in st.session_state:
     st.session_state.previous_roundtrip = None
+if 'previous_batch_size' not in st.session_state:
+    st.session_state.previous_batch_size = None
 if 'previous_osmr_url' not in st.session_state:
     st.session_state.previous_osmr_url = None
 
@@ -212,12 +376,15 @@ with col2:
                                                                      "or reduce them in number, this may cause some "
                                                                      "unpredictable behavior ")
     roundtrip = st.checkbox("Make it a roundtrip", value=False)
+    batch_size = st.number_input("OSRM batch size", min_value=50, max_value=500, value=100, step=10,
+                                 help="Maximum number of points sent in a single request to the OSRM server, "
+                                      "longer trips are split into consecutive requests sent in parallel")
     verify_coverage = st.checkbox("Verify point coverage", value=st.session_state.verify_coverage,
                                   key='verify_coverage')
 
     if verify_coverage:
         max_distance = st.slider("Maximum distance for point coverage (meters)",
-                                 min_value=1, max_value=100, value=st.session_state.max_distance, step=1,
+                                 min_value=5, max_value=100, value=st.session_state.max_distance, step=5,
                                  key='max_distance', on_change=update_uncovered_points)
     else:
         max_distance = None
@@ -231,6 +398,7 @@ with col2:
     if (transport_mode_display != st.session_state.previous_transport_mode or
             optimize_points != st.session_state.previous_optimize_points or
             roundtrip != st.session_state.previous_roundtrip or
+            batch_size != st.session_state.previous_batch_size or
             osmr_url != st.session_state.previous_osmr_url):
         reset_trip_calculation()
 
@@ -238,15 +406,19 @@ with col2:
     st.session_state.previous_transport_mode = transport_mode_display
     st.session_state.previous_optimize_points = optimize_points
     st.session_state.previous_roundtrip = roundtrip
+    st.session_state.previous_batch_size = batch_size
     st.session_state.previous_osmr_url = osmr_url
 
-if points_file is not None:
-    points = gpd.read_file(points_file).reset_index(drop=True)
+st.sidebar.header("Map options:")
+route_tolerance = st.sidebar.slider("Route simplification tolerance (degrees)",
+                                    min_value=0.0, max_value=1e-4, value=ROUTE_TOLERANCE, step=1e-6, format="%.6f",
+                                    help="Vertices of the drawn route closer than this to a straight line are "
+                                         "dropped, higher values make the map lighter but less precise")
 
-    if points.crs != 'EPSG:4326':
-        points = points.to_crs('EPSG:4326')
+if points_file is not None:
+    points = load_points(points_file.getvalue())
 
-    if not all(points.geometry.type == 'Point'):
+    if not np.all(points.geometry.geom_type.to_numpy() == 'Point'):
         st.error("The uploaded GeoJSON must contain only points. Please upload a different file.")
     else:
         # Filter options
@@ -255,15 +427,11 @@ if points_file is not None:
                                value=min(100, len(points)))
 
         # Filter points
-        filtered_points = points.head(num_points)
+        filtered_points = points.iloc[:num_points]
 
         # Expandable section for uploaded points
         with st.expander("View Uploaded Points"):
-            m = folium.Map(location=[filtered_points.geometry.y.mean(), filtered_points.geometry.x.mean()],
-                           zoom_start=10)
-            for idx, row in filtered_points.iterrows():
-                folium.Marker([row.geometry.y, row.geometry.x], popup=f"Point {idx}").add_to(m)
-            folium_static(m)
+            components.html(render_map(create_points_map(filtered_points)), width=700, height=510)
 
         # Add toggle for point selection
         select_specific_points = st.toggle("Select specific start and end points", value=False)
@@ -274,15 +442,17 @@ if points_file is not None:
         if select_specific_points:
             st.subheader("Select Start and End Points")
 
+            # the option labels are formatted once, instead of looking up every point for each selectbox
+            point_labels = [f"Point {i}: ({y:.6f}, {x:.6f})"
+                            for i, (x, y) in enumerate(shapely.get_coordinates(filtered_points.geometry.values).tolist())]
+
             start_index = st.selectbox("Select start point:", range(len(filtered_points)),
-                                       format_func=lambda
-                                           x: f"Point {x}: ({filtered_points.iloc[x].geometry.y:.6f}, {filtered_points.iloc[x].geometry.x:.6f})")
-            start_point = filtered_points.iloc[start_index].geometry
+                                       format_func=point_labels.__getitem__)
+            start_point = filtered_points.geometry.values[start_index]
 
             end_index = st.selectbox("Select end point:", range(len(filtered_points)),
-                                     format_func=lambda
-                                         x: f"Point {x}: ({filtered_points.iloc[x].geometry.y:.6f}, {filtered_points.iloc[x].geometry.x:.6f})")
-            end_point = filtered_points.iloc[end_index].geometry
+                                     format_func=point_labels.__getitem__)
+            end_point = filtered_points.geometry.values[end_index]
 
             # Display selected points
             st.write(f"Start point selected: {start_point.y:.6f}, {start_point.x:.6f}")
@@ -294,70 +464,31 @@ if points_file is not None:
             if not st.session_state.trip_calculated:
                 with st.spinner("Calculating optimal trip..."):
                     st.session_state.filtered_points = filtered_points
-                    st.session_state.trip_gdf, st.session_state.uncovered_points = calculate_trip(
-                        filtered_points,
-                        profile=profile,
-                        roundtrip=roundtrip,
-                        base_url=osmr_url,
-                        streets=streets,
-                        optimize_points=optimize_points,
-                        start_point=start_point,
-                        end_point=end_point,
-                        max_distance=max_distance if verify_coverage else None
-                    )
+                    try:
+                        st.session_state.trip_gdf, st.session_state.uncovered_points = cached_calculate_trip(
+                            filtered_points,
+                            profile=profile,
+                            roundtrip=roundtrip,
+                            base_url=osmr_url,
+                            streets=streets,
+                            optimize_points=optimize_points,
+                            start_point=start_point,
+                            end_point=end_point,
+                            max_distance=max_distance if verify_coverage else None,
+                            batch_size=batch_size
+                        )
+                    except TripNotFoundError:
+                        st.session_state.trip_gdf, st.session_state.uncovered_points = None, None
                     st.session_state.trip_calculated = True
 
             if st.session_state.trip_gdf is not None and not st.session_state.trip_gdf.empty:
-                with st.expander("View Calculated Trip", expanded=True):
-                    st.subheader("Map of Calculated Trip")
-
-                    # Create and display the map
-                    m = create_trip_map(st.session_state.trip_gdf, filtered_points, st.session_state.uncovered_points,
-                                        verify_coverage)
-                    folium_static(m)
-
-                    # Display statistics
-                    display_trip_statistics(st.session_state.trip_gdf, profile, verify_coverage,
-                                            st.session_state.uncovered_points, max_distance)
-
-                    # Download buttons
-                    col1, col2 = st.columns(2)
-
-                    with col1:
-                        trip_geojson = st.session_state.trip_gdf.to_json()
-                        st.download_button(
-                            label="Download trip as GeoJSON",
-                            data=trip_geojson,
-                            file_name="trip.geojson",
-                            mime="application/json"
-                        )
-
-                    with col2:
-                        if st.session_state.uncovered_points is not None and not st.session_state.uncovered_points.empty:
-                            uncovered_geojson = st.session_state.uncovered_points.to_json()
-                            st.download_button(
-                                label="Download uncovered points as GeoJSON",
-                                data=uncovered_geojson,
-                                file_name="uncovered_points.geojson",
-                                mime="application/json"
-                            )
+                display_calculated_trip(filtered_points, profile, verify_coverage, max_distance, route_tolerance)
             else:
                 st.error("Failed to calculate the trip. Please try again.")
 
 # Add some instructions and information
 st.sidebar.header("How to use:")
-st.sidebar.write("""
-1. Upload a GeoJSON file containing points.
-2. Select your transportation mode.
-3. Choose whether you want a roundtrip.
-4. Adjust the number of points to use with the slider.
-5. Click 'Start Trip Calculation'.
-6. View your optimized route and trip statistics.
-7. Download the route as a GeoJSON file if desired.
-""")
+st.sidebar.write(HOW_TO_USE_TEXT)
 
 st.sidebar.header("About:")
-st.sidebar.write("""
-This app uses the OSM (Open Street Map) to calculate optimal routes between multiple points. 
-It's perfect for planning trips, deliveries, or any scenario where you need to visit multiple locations efficiently.
-""")
+st.sidebar.write(ABOUT_TEXT)
@@ -1,21 +1,41 @@
+import pickle
+from functools import lru_cache, reduce
 from typing import Optional, Tuple
 
-import folium
+import numpy as np
+import pandas as pd
 import requests
+import shapely
 import streamlit as st
 from shapely import Point
-from streamlit_folium import folium_static
-from folium.plugins import MarkerCluster
 import geopandas as gpd
+from geopandas.array import from_shapely
+from pyproj import CRS, Geod
 from shapely.geometry import Polygon
-import polyline
 
 from osm_utils import get_gdfs_from_polygon, filter_data, merge_points_gdf_with_streets_edges, \
-    convert_gdf_to_single_point_list
-from routing import get_osrm_trip
+    simplify_linestrings_batch, reproject_geometries, reproject_gdf
+from routing import encode_polyline, get_osrm_trips_batch
 
 from enum import Enum
 
+# CRS of the routes and results, the routes lengths are measured on its ellipsoid
+_WGS84 = CRS.from_epsg(4326)
+_WGS84_GEOD = Geod(ellps='WGS84')
+
+# ASCII codes of the two hex digits of every byte value, to format colors without Python string formatting
+_HEX_DIGITS = np.frombuffer(''.join(f'{i:02x}' for i in range(256)).encode(), dtype=np.uint8).reshape(256, 2)
+
+# Leaflet callback building a marker from a [lat, lon, popup, tooltip] row of FastMarkerCluster
+DISPLAY_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2], {maxWidth: 300});
+    marker.bindTooltip(row[3]);
+    return marker;
+};
+"""
+
 
 class TransportProfile(Enum):
     CAR = ("Car", "driving", "drive", 20)  # Nome, OSRM profile, OSM network type, average speed (km/h)
@@ -30,16 +50,20 @@ class TransportProfile(Enum):
 
     @classmethod
     def get_by_display_name(cls, name):
-        for profile in cls:
-            if profile.display_name == name:
-                return profile
-        raise ValueError(f"No TransportProfile found for name: {name}")
+        try:
+            return _PROFILES_BY_DISPLAY_NAME[name]
+        except KeyError:
+            raise ValueError(f"No TransportProfile found for name: {name}") from None
 
     @classmethod
     def get_all_osrm_profiles(cls):
         return [profile.osrm_profile for profile in cls]
 
 
+# lookup of the profiles by their display name, built once instead of scanning them on every rerun
+_PROFILES_BY_DISPLAY_NAME = {profile.display_name: profile for profile in TransportProfile}
+
+
 def compute_polygon_buffer(gdf: gpd.GeoDataFrame, buffer_distance: float = 0.01) -> Polygon:
     """
     Processes the input GeoDataFrame to create a buffered convex hull.
@@ -60,14 +84,14 @@ def compute_polygon_buffer(gdf: gpd.GeoDataFrame, buffer_distance: float = 0.01)
     if gdf.empty:
         raise ValueError("The input GeoDataFrame is empty")
 
-    # Combine all geometries into a single geometry (unary union)
-    combined_geometry = gdf.geometry.unary_union
+    # Collect the coordinates of all geometries, the convex hull of their union is the one of their vertices
+    coords = shapely.get_coordinates(gdf.geometry.values)
 
-    # Compute the convex hull of the combined geometry
-    convex_hull = combined_geometry.convex_hull
+    # Compute the convex hull of the coordinates
+    convex_hull = shapely.convex_hull(shapely.multipoints(coords))
 
     # Apply a buffer to the convex hull
-    buffered_convex_hull = convex_hull.buffer(buffer_distance)
+    buffered_convex_hull = shapely.buffer(convex_hull, buffer_distance)
 
     if not isinstance(buffered_convex_hull, Polygon):
         raise ValueError("The processed geometry is not a valid Polygon")
@@ -82,7 +106,8 @@ def calculate_trip(gdf: gpd.GeoDataFrame,
                    optimize_points: bool = False,
                    start_point: Point = None,
                    end_point: Point = None,
-                   max_distance: float = 10.0) -> Tuple[Optional[gpd.GeoDataFrame], Optional[gpd.GeoDataFrame]]:
+                   max_distance: float = 10.0,
+                   batch_size: Optional[int] = None) -> Tuple[Optional[gpd.GeoDataFrame], Optional[gpd.GeoDataFrame]]:
     """
     Calculate a trip route and identify uncovered points.
 
@@ -96,6 +121,9 @@ def calculate_trip(gdf: gpd.GeoDataFrame,
         start_point: The starting point for the trip (optional).
         end_point: The destination point for the trip (optional).
         max_distance: The maximum distance (in meters) for a point to be considered covered by the route.
+        batch_size: The maximum number of points sent in a single OSRM trip request (optional). Longer point
+            lists are split into consecutive batches, each starting from the last point of the previous one,
+            which are requested in parallel and chained together.
 
     Returns:
         A tuple containing:
@@ -103,12 +131,15 @@ def calculate_trip(gdf: gpd.GeoDataFrame,
         - A GeoDataFrame containing the uncovered points, or None if all points are covered.
 
     Raises:
-        ValueError: If the input GeoDataFrame is empty.
+        ValueError: If the input GeoDataFrame is empty or batch_size is lower than 2.
         AssertionError: If the input GeoDataFrame does not have a valid CRS.
     """
     if gdf.empty:
         raise ValueError("The input GeoDataFrame is empty")
 
+    if batch_size is not None and batch_size < 2:
+        raise ValueError("batch_size must be at least 2")
+
     assert gdf.crs is not None, "The input GeoDataFrame must have a valid CRS"
 
     # Remove index columns if present
@@ -132,47 +163,65 @@ def calculate_trip(gdf: gpd.GeoDataFrame,
         if streets:
             gdf_streets = gdf_streets[gdf_streets['highway'].isin(streets)]
 
-        # Convert the merged GeoDataFrame to a list of single points
-        point_list = convert_gdf_to_single_point_list(gdf_streets, points_between=-1)
+        # Convert the merged GeoDataFrame to a single array of (lat, lon) points
+        point_coords = simplify_linestrings_batch(gdf_streets.geometry, points_between=-1)[:, ::-1]
     else:
-        point_list = [(point.y, point.x) for point in gdf.geometry]
+        point_coords = shapely.get_coordinates(gdf.geometry.values)[:, ::-1]
+
+    # Drop the points which are the same at the precision of the encoded polyline, keeping their order,
+    # as consecutive street segments share their endpoints and OSRM gains nothing from repeated waypoints
+    _, first_index = np.unique(np.round(point_coords * 1e5).astype(np.int64), axis=0, return_index=True)
+    point_coords = point_coords[np.sort(first_index)]
 
     if start_point:
-        point_list.insert(0, (start_point.y, start_point.x))
+        point_coords = np.vstack([[[start_point.y, start_point.x]], point_coords])
     if end_point:
-        point_list.append((end_point.y, end_point.x))
-
-    # Encode the points list to a polyline
-    encoded_polyline = polyline.encode(point_list)
-
-    # Get the trip routes using the OSRM API
-    routes = get_osrm_trip(encoded_polyline,
-                           profile=profile.osrm_profile,
-                           roundtrip=str(roundtrip).lower(),
-                           base_url=base_url)
-
-    if isinstance(routes, requests.Response):
-        st.error(f"OSRM API error: {routes.status_code} - {routes.text}")
-        return None
+        point_coords = np.vstack([point_coords, [[end_point.y, end_point.x]]])
 
-    # Assert that routes are found
-    if not routes:
+    if batch_size is None or len(point_coords) <= batch_size:
+        batches = [point_coords]
+    else:
+        if roundtrip:
+            # the trip goes back to the start in the last batch, as OSRM can only close the loop of a single request
+            point_coords = np.vstack([point_coords, point_coords[:1]])
+            roundtrip = False
+        # consecutive batches share their boundary point, so that their trips are chained
+        batches = [point_coords[i:i + batch_size] for i in range(0, len(point_coords) - 1, batch_size - 1)]
+
+    # Encode the points arrays to polylines
+    encoded_polylines = [encode_polyline(batch) for batch in batches]
+
+    # Get the trip routes of all the batches using the OSRM API
+    batch_routes = get_osrm_trips_batch(encoded_polylines,
+                                        profile=profile.osrm_profile,
+                                        roundtrip=str(roundtrip).lower(),
+                                        base_url=base_url)
+
+    for response in batch_routes:
+        if isinstance(response, requests.Response):
+            st.error(f"OSRM API error: {response.status_code} - {response.text}")
+            return None, None
+
+    # Assert that routes are found for every batch, a missing one would leave a gap in the trip
+    if any(routes is None for routes in batch_routes):
         st.warning("No valid routes found")
-        return None
+        return None, None
 
-    # Create a GeoDataFrame from the routes
-    routes_gdf = gpd.GeoDataFrame(geometry=routes, crs="EPSG:4326")
+    routes = [route for routes in batch_routes for route in routes]
 
-    gdf = gdf.drop(columns=['index_right'], errors='ignore')
-    # Use sjoin_nearest to find uncovered points
-    covered_points = gpd.sjoin_nearest(gdf.to_crs("EPSG:3857"), routes_gdf.to_crs("EPSG:3857"), how="left", max_distance=max_distance)
+    # Create a GeoDataFrame from the routes, wrapped at once in a geometry array
+    routes_gdf = gpd.GeoDataFrame(geometry=from_shapely(np.asarray(routes, dtype=object), crs=_WGS84))
 
     routes_gdf.reset_index(inplace=True)
-    uncovered_points = covered_points[covered_points['index_right'].isna()]
-    if not uncovered_points.empty:
+
+    # Find the uncovered points with the spatial index of the routes, without a limit all the points are covered
+    uncovered_points = None
+    if max_distance is not None:
+        uncovered_points = recalculate_uncovered_points(routes_gdf, gdf, max_distance)
+    if uncovered_points is not None:
         st.warning(
             f"{len(uncovered_points)} points were not covered by the calculated route (max distance: {max_distance} meters).")
-        return routes_gdf, uncovered_points.to_crs(epsg=4326)
+        return routes_gdf, uncovered_points
     else:
         st.success(f"All points were covered by the calculated route (max distance: {max_distance} meters).")
         return routes_gdf, None
@@ -180,10 +229,53 @@ def calculate_trip(gdf: gpd.GeoDataFrame,
 def recalculate_uncovered_points(trip_gdf: gpd.GeoDataFrame,
                                  points_gdf: gpd.GeoDataFrame,
                                  max_distance: float) -> Optional[gpd.GeoDataFrame]:
-    covered_points = gpd.sjoin_nearest(points_gdf.to_crs("EPSG:3857"), trip_gdf.to_crs("EPSG:3857"), how="left",
-                                       max_distance=max_distance)
-    uncovered_points = covered_points[covered_points['index_right0'].isna()]
-    return uncovered_points.to_crs(epsg=4326) if not uncovered_points.empty else None
+    # Find the points within max_distance of a route, in the local UTM zone
+    utm_crs = points_gdf.estimate_utm_crs()
+    tree = shapely.STRtree(reproject_geometries(trip_gdf.geometry.values, trip_gdf.crs, utm_crs))
+    points_index, _ = tree.query(reproject_geometries(points_gdf.geometry.values, points_gdf.crs, utm_crs),
+                                 predicate='dwithin', distance=max_distance)
+
+    covered = np.zeros(len(points_gdf), dtype=bool)
+    covered[points_index] = True
+    uncovered_points = points_gdf.iloc[~covered]
+    return reproject_gdf(uncovered_points, _WGS84) if not uncovered_points.empty else None
+
+def hash_geodataframe(gdf: gpd.GeoDataFrame) -> bytes:
+    """
+    Hash a GeoDataFrame for the Streamlit caches, which are not able to hash it on their own.
+
+    Args:
+        gdf: The GeoDataFrame to hash.
+
+    Returns:
+        The hash of the values, index, geometries and CRS of the GeoDataFrame.
+    """
+    # pickling also handles attributes holding lists or dicts, which pandas hashing rejects
+    return pickle.dumps(pd.DataFrame(gdf.to_wkb())) + str(gdf.crs).encode()
+
+
+def compute_trip_length(trip_gdf: gpd.GeoDataFrame) -> float:
+    """
+    Compute the total length of a trip in kilometers.
+
+    The lengths are geodesic, measured on the WGS84 ellipsoid between all consecutive vertices
+    of the routes at once, so they stay exact for trips spanning several UTM zones.
+
+    Args:
+        trip_gdf: A GeoDataFrame containing the routes of the trip.
+
+    Returns:
+        The total length of the trip in kilometers.
+    """
+    routes = reproject_geometries(trip_gdf.geometry.values, trip_gdf.crs, _WGS84)
+    coords, route_index = shapely.get_coordinates(routes, return_index=True)
+
+    # only the pairs of consecutive vertices belonging to the same route are segments
+    same_route = route_index[1:] == route_index[:-1]
+    _, _, distances = _WGS84_GEOD.inv(coords[:-1, 0][same_route], coords[:-1, 1][same_route],
+                                      coords[1:, 0][same_route], coords[1:, 1][same_route])
+    return float(distances.sum()) / 1000
+
 
 def update_point(point_type):
     if f'{point_type}_point_coords' in st.session_state:
@@ -193,31 +285,37 @@ def update_point(point_type):
 def handle_map_click(lat, lon):
     return Point(lon, lat)
 def display_map(gdf):
+    import folium
+    from folium.plugins import FastMarkerCluster
+    from streamlit_folium import folium_static
+
     # Display the map
     st.subheader("Map Visualization")
 
-    # Create a Folium map
-    m = folium.Map(location=[gdf.geometry.y.mean(),
-                             gdf.geometry.x.mean()],
-                   zoom_start=10)
+    coords = shapely.get_coordinates(gdf.geometry.values)
 
-    # Create a MarkerCluster
-    marker_cluster = MarkerCluster().add_to(m)
+    # Create a Folium map, centered on the mean of the points
+    center_x, center_y = coords.mean(axis=0)
+    m = folium.Map(location=[center_y, center_x],
+                   zoom_start=10)
 
-    # Add points to the map with popup information
-    for idx, row in gdf.iterrows():
-        # Create popup content
-        popup_content = "<br>".join([f"{col}: {val}" for col, val in row.items() if col != 'geometry'])
+    # Create the popups content of all the points at once, concatenating the columns as whole strings
+    labelled_columns = [col + ": " + gdf[col].map(str) for col in gdf.columns if col != 'geometry']
+    if labelled_columns:
+        popup_contents = reduce(lambda left, right: left + "<br>" + right, labelled_columns).tolist()
+    else:
+        popup_contents = [""] * len(gdf)
 
-        # Add marker
-        folium.Marker(
-            location=[row.geometry.y, row.geometry.x],
-            popup=folium.Popup(popup_content, max_width=300),
-            tooltip=f"Point {idx}"
-        ).add_to(marker_cluster)
+    # Add points to the map with popup information, the markers are built client side by a single callback
+    FastMarkerCluster(
+        [[y, x, popup_content, f"Point {idx}"]
+         for idx, (x, y), popup_content in zip(gdf.index, coords.tolist(), popup_contents)],
+        callback=DISPLAY_MARKER_CALLBACK
+    ).add_to(m)
 
     # Fit the map to the bounds of the data
-    m.fit_bounds(m.get_bounds())
+    (min_x, min_y), (max_x, max_y) = coords.min(axis=0), coords.max(axis=0)
+    m.fit_bounds([[min_y, min_x], [max_y, max_x]])
 
     # Display the map in Streamlit
     folium_static(m)
@@ -227,9 +325,28 @@ def display_map(gdf):
     st.dataframe(gdf.drop(columns=['geometry'], errors="ignore"))
 
 
+@lru_cache(maxsize=32)
+def hex_to_rgb(color):
+    """Parse a '#rrggbb' color into its (r, g, b) components, the same few colors are parsed only once."""
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+
 def interpolate_color(value, start_color, end_color):
     """Interpolate color from start_color to end_color based on value in [0, 1]."""
-    start_color = [int(start_color[i:i + 2], 16) for i in (1, 3, 5)]
-    end_color = [int(end_color[i:i + 2], 16) for i in (1, 3, 5)]
+    start_color = hex_to_rgb(start_color)
+    end_color = hex_to_rgb(end_color)
     color = [int(start + (end - start) * value) for start, end in zip(start_color, end_color)]
     return f'#{color[0]:02x}{color[1]:02x}{color[2]:02x}'
+
+
+def interpolate_colors(values, start_color, end_color):
+    """Interpolate colors from start_color to end_color for an array of values in [0, 1], all at once."""
+    start_rgb = np.array(hex_to_rgb(start_color))
+    end_rgb = np.array(hex_to_rgb(end_color))
+    rgb = (start_rgb + np.outer(values, end_rgb - start_rgb)).astype(np.uint8)
+
+    # format all the colors at once, writing the '#rrggbb' characters of each one from a lookup table
+    chars = np.empty((len(rgb), 7), dtype=np.uint8)
+    chars[:, 0] = ord('#')
+    chars[:, 1:] = _HEX_DIGITS[rgb].reshape(len(rgb), 6)
+    return chars.view('S7').ravel().astype(str).tolist()